@@ -0,0 +1,62 @@
+"""Celery application for processing WhatsApp messages in the background."""
+
+import os
+import logging
+
+from celery import Celery
+from celery.signals import worker_process_init
+
+from config import REDIS_URL
+
+# The tasks are I/O-bound (Gemini, Sheets and WhatsApp HTTP calls), so the
+# worker should use a gevent pool with concurrency far above the core count:
+#   celery -A celery_app worker -P gevent -c ${CELERY_WORKER_CONCURRENCY:-300}
+WORKER_CONCURRENCY = int(os.getenv("CELERY_WORKER_CONCURRENCY", "300"))
+
+celery_app = Celery(
+    "leoai",
+    broker=REDIS_URL,
+    backend=REDIS_URL,
+)
+
+celery_app.conf.update(
+    worker_pool="gevent",
+    worker_concurrency=WORKER_CONCURRENCY,
+    broker_pool_limit=int(os.getenv("CELERY_BROKER_POOL_LIMIT", "50")),
+    # Nothing reads task results; skipping the result backend write saves a
+    # Redis round-trip per message.
+    task_ignore_result=True,
+)
+
+
+@worker_process_init.connect
+def init_worker_resources(**kwargs):
+    """Warms the per-process clients right after a worker child starts.
+
+    Clients that hold sockets (Gemini, Sheets) must not be inherited across
+    a fork; building them here gives each child its own connections and
+    moves the one-time init cost out of the first task.
+    """
+    try:
+        from services import ai_service, google_service
+        ai_service._get_client()
+        google_service._get_sheets_service()
+    except Exception as e:
+        logging.warning(f"Could not warm worker clients, they will init lazily: {e}")
+
+
+@celery_app.task(bind=True, max_retries=3, acks_late=True)
+def process_message_task(self, data: dict):
+    """Processes an incoming WhatsApp webhook payload outside the request cycle.
+
+    The webhook handler returns 200 to Meta immediately and this task does the
+    slow work (Gemini + Google Sheets + WhatsApp reply) in a worker process.
+    """
+    # Imported lazily so the worker only pays the import cost once it runs.
+    from services import handle_whatsapp_message
+
+    try:
+        handle_whatsapp_message(data)
+    except Exception as e:
+        logging.error(f"Background message processing failed: {e}")
+        raise self.retry(exc=e, countdown=5)
@@ -0,0 +1,10 @@
+"""Process-wide configuration snapshotted from the environment at import time.
+
+Modules import these constants instead of calling os.getenv per use, so the
+environment is read exactly once per process.
+"""
+
+import os
+
+# Shared by the Celery broker, the dedup store and the Gemini response cache.
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
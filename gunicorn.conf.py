@@ -0,0 +1,14 @@
+"""Gunicorn configuration for serving the Flask app in production."""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+
+# The webhook handler is I/O-bound (it only enqueues work), so threaded
+# workers handle many concurrent requests per process.
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+
+timeout = 30
@@ -2,17 +2,46 @@
 
 import os
 import logging
-from flask import Blueprint, request, jsonify, Response
+from flask import Blueprint, request, Response
+
+# orjson parses the webhook body several times faster than the stdlib; fall
+# back to json if it is not installed.
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+    _json_loads = json.loads
 
 # Import the main handler function from the services module
 from services import handle_whatsapp_message
 
+from utils.security import validate_whatsapp_signature
+
+# Try to set up the Celery task queue. If the broker/worker is not available,
+# messages are processed inline as before (same pattern as secrets.py).
+try:
+    from celery_app import process_message_task
+    CELERY_AVAILABLE = True
+except Exception as e:
+    logging.warning(f"Celery is not available, messages will be processed inline: {e}")
+    process_message_task = None
+    CELERY_AVAILABLE = False
+
 # Create a Blueprint for the webhook routes
 webhook_blueprint = Blueprint('webhook', __name__)
 
+# The ACK body never changes, so serve the same pre-serialized bytes instead
+# of running jsonify/json.dumps on every delivery.
+_ACK_BODY = b'{"status": "ok"}'
+
 # Get the verification token from environment variables
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN")
 
+# App secret used to verify the X-Hub-Signature-256 header. If it is not
+# configured, signature validation is skipped.
+APP_SECRET = os.getenv("WHATSAPP_APP_SECRET")
+
 @webhook_blueprint.route('/webhook', methods=['GET', 'POST'])
 def webhook():
     """Handles incoming webhook requests from WhatsApp."""
@@ -31,12 +60,37 @@ def webhook():
             return Response("Verification failed", status=403)
 
     elif request.method == 'POST':
+        # Read the raw body once: the same bytes feed the signature check and
+        # the JSON parse, so the payload is never parsed or serialized twice.
+        raw_body = request.get_data()
+
+        # Validate the signature against the raw body exactly as Meta sent it;
+        # re-serializing the parsed JSON would break the HMAC comparison.
+        if APP_SECRET:
+            signature = request.headers.get('X-Hub-Signature-256')
+            if not validate_whatsapp_signature(raw_body, signature, APP_SECRET):
+                logging.warning("Webhook signature validation failed. Discarding payload.")
+                return Response("Invalid signature", status=403)
+
         # This is an incoming message from a user
-        data = request.get_json()
+        try:
+            data = _json_loads(raw_body)
+        except ValueError as e:
+            logging.warning(f"Could not parse webhook body as JSON: {e}")
+            return Response("Invalid JSON", status=400)
         logging.info("Received incoming message payload.")
         
-        # Pass the entire payload to the handler function in services
-        handle_whatsapp_message(data)
-        
+        # Enqueue the payload so the webhook can ACK immediately; Gemini +
+        # Sheets + the WhatsApp reply run in a Celery worker instead of
+        # blocking this request (Meta retries webhooks slower than ~5s).
+        if CELERY_AVAILABLE:
+            try:
+                process_message_task.delay(data)
+            except Exception as e:
+                logging.error(f"Could not enqueue message, processing inline: {e}")
+                handle_whatsapp_message(data)
+        else:
+            handle_whatsapp_message(data)
+
         # Return a 200 OK to acknowledge receipt of the message
-        return jsonify({"status": "ok"}), 200
+        return Response(_ACK_BODY, status=200, mimetype='application/json')
@@ -0,0 +1,6 @@
+#!/bin/sh
+source .venv/bin/activate
+
+# Production entry point. The Flask dev server (devserver.sh) is
+# single-threaded and should only be used locally.
+gunicorn -c gunicorn.conf.py app:app
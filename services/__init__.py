@@ -1,7 +1,7 @@
 """Handles the main business logic by orchestrating calls to various services."""
 
 import logging
-import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Optional, Tuple
 
@@ -9,28 +9,68 @@ from . import ai_service
 from . import google_service
 from . import whatsapp_service
 from . import app_service
+from . import dedup_service
+
+# orjson decodes the Gemini JSON noticeably faster than the stdlib; fall
+# back to json when it is not installed (same pattern as routes.py).
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+    _json_loads = json.loads
 
 from utils.errors import UnAuthorizedUserException
 from utils.errors import AIProccesingException
+from utils.expense import ExpenseData
+
+# Shared pool used to run independent I/O calls (Drive upload, Sheets
+# append, WhatsApp reply) in parallel instead of serially awaiting each
+# HTTP round-trip.
+_executor = ThreadPoolExecutor(max_workers=16)
 
 def handle_whatsapp_message(data: dict):
     """Main handler for incoming WhatsApp messages."""
-    try:
-        entry = data.get('entry', [{}])[0]
-        changes = entry.get('changes', [{}])[0]
-        value = changes.get('value', {})
+    # Walk the payload with .get chains and bail out early on anything that
+    # is not a user message; malformed payloads are cheap no-ops instead of
+    # raising KeyError/IndexError halfway through.
+    entry = (data.get('entry') or [{}])[0]
+    changes = (entry.get('changes') or [{}])[0]
+    value = changes.get('value') or {}
+
+    # 2. IMPORTANTE: Verificar si es un mensaje o un cambio de estado
+    if 'statuses' in value:
+        logging.info("Es una actualización de estado (sent/delivered/read). Ignorando.")
+        return
 
-        # 2. IMPORTANTE: Verificar si es un mensaje o un cambio de estado
-        if 'statuses' in value:
-            logging.info("Es una actualización de estado (sent/delivered/read). Ignorando.")
-            return
+    messages = value.get('messages') or []
+    if not messages:
+        logging.info("Payload sin mensajes. Ignorando.")
+        return
 
-        if 'messages' in value:
-            message = value['messages'][0]
+    # Meta can batch several messages into a single delivery; handle each one
+    # instead of silently dropping everything after messages[0].
+    for message_data in messages:
+        _handle_single_message(message_data)
 
-        message_data = value['messages'][0]
-        sender_phone = message_data['from']
-        
+def _handle_single_message(message_data: dict):
+    """Processes one entry of the messages[*] array."""
+    sender_phone = message_data.get('from')
+    if not sender_phone:
+        logging.warning(f"Mensaje sin remitente. Ignorando. Received data: {message_data}")
+        return
+
+    # Meta retries deliveries, so drop messages we already processed.
+    message_id = message_data.get('id')
+    if dedup_service.is_duplicate_message(message_id):
+        logging.info(f"Mensaje duplicado {message_id}. Ignorando.")
+        return
+
+    if dedup_service.is_rate_limited(sender_phone):
+        logging.warning(f"Usuario {sender_phone} superó el límite de mensajes por minuto. Ignorando.")
+        return
+
+    try:
         logging.debug(f"Validando usuario {sender_phone}" )
         app_service.validate_allowed_users(sender_phone)
 
@@ -45,70 +85,100 @@ def handle_whatsapp_message(data: dict):
             ai_response = app_service.handle_text_message(message_data)
 
         elif message_type in ['image', 'document']:
-            ai_response, file_bytes = app_service.handle_message_with_attachement(message_data, message_type)
+            ai_response, file_bytes, mimetype = app_service.handle_message_with_attachement(message_data, message_type)
     
         else:
             logging.warning(f"Unsupported message type: {message_type}")
 
-        handle_ai_response(timestamp, sender_phone, ai_response, file_bytes, mimetype)
+        # A re-sent receipt arrives under a fresh message ID, so the ID-level
+        # dedup misses it; identical (sender, text, bytes) within the window
+        # gets an ack instead of a second sheet row and Drive copy. The
+        # Gemini call for it was already a response-cache hit.
+        if message_type == 'text':
+            content_text = message_data.get('text', {}).get('body', '')
+        else:
+            content_text = (message_data.get(message_type) or {}).get('caption', '')
+
+        if ai_response and dedup_service.is_duplicate_content(sender_phone, content_text, file_bytes):
+            logging.info("Contenido duplicado de %s. Enviando solo confirmación.", sender_phone)
+            whatsapp_service.send_whatsapp_message(
+                sender_phone, "⚠️ Ese mensaje ya fue registrado hace poco, no lo guardo de nuevo."
+            )
+            return
+
+        saved = handle_ai_response(timestamp, sender_phone, ai_response, file_bytes, mimetype)
+
+        # Mark the content only once the expense actually landed, so a
+        # failed attempt never swallows the user's immediate retry.
+        if saved:
+            dedup_service.mark_content_processed(sender_phone, content_text, file_bytes)
 
     except UnAuthorizedUserException as e:
         whatsapp_service.send_whatsapp_message(sender_phone, "Lo siento, no eres un usuario autorizado para usar este chat.")
     except AIProccesingException as e:
         whatsapp_service.send_whatsapp_message(sender_phone, "Lo siento, no pude procesar tu mensaje.")
-    except (KeyError, IndexError) as e:
-        logging.error(f"Could not parse WhatsApp webhook payload: {e}")
-        logging.error(f"Received data: {data}")
-
-        """{'object': 'whatsapp_business_account', 'entry': [{'id': '4223017651301496', 'changes': [{'value': {'messaging_product': 'whatsapp', 'metadata': {'display_phone_number': '34624965144', 'phone_number_id': '940327099169335'}, 'statuses': [{'id': 'wamid.HBgLMzQ2MjQ3NjIyNDUVAgARGBJEQjI2MjdEQzE4Q0NGRTg5OEQA', 'status': 'sent', 'timestamp': '1772577070', 'recipient_id': '34624762245', 'pricing': {'billable': False, 'pricing_model': 'PMP', 'category': 'service', 'type': 'free_customer_service'}}]}, 'field': 'messages'}]}]}"""
-
-        whatsapp_service.send_whatsapp_message(sender_phone, "❌ Could not parse WhatsApp webhook payload.")
     except Exception as e:
         logging.error(f"An unexpected error occurred: {e}")
         whatsapp_service.send_whatsapp_message(sender_phone, "❌ Lo siento, algo raro paso.")
 
+    # Every branch above ends with the user informed, so the message counts
+    # as handled; only now does the dedup marker become permanent. A crash
+    # before this point leaves just the short-lived in-flight claim, letting
+    # the broker's redelivery reprocess the message.
+    dedup_service.mark_message_processed(message_id)
+
 def handle_ai_response(
     timestamp: str, 
     sender_phone: str, 
     ai_response: Optional[str], 
     file_bytes: Optional[bytes] = None,
     mimetype: Optional[str] = None
-):
-    """Handles the response from the AI service, saving data and images."""
+) -> bool:
+    """Handles the response from the AI service, saving data and images.
+
+    Returns True only when the expense row was written, so the caller can
+    tell a registered message apart from a failed or rejected one.
+    """
     if not ai_response:
         logging.warning("AI response was empty. Cannot process further.")
         whatsapp_service.send_whatsapp_message(sender_phone, "❌ AI response was empty. Cannot process further.")
-        return
+        return False
 
     try:
         logging.info(f"AI response: {ai_response}")
-        print(f"AI response: {ai_response}")
 
-        expense_data = json.loads(ai_response)
+        # Parse and normalize the shape once instead of dict.get everywhere.
+        expense_data = ExpenseData.from_dict(_json_loads(ai_response))
 
-        logging.info("expense_data")
-
-        valid_expense = expense_data.get('valid_expense') or False
-        if not valid_expense:
+        if not expense_data.valid_expense:
             logging.warning("Invalid expense. Not saving to Google Sheets.")
-            error_message = expense_data.get('message') or "❌ Invalid expense. Not saving to Google Sheets."
-            whatsapp_service.send_whatsapp_message(sender_number, error_message)
+            error_message = expense_data.message or "❌ Invalid expense. Not saving to Google Sheets."
+            whatsapp_service.send_whatsapp_message(sender_phone, error_message)
+            return False
 
         format_date = datetime.now().strftime("%Y-%m-%d")
-        date_for_drive = expense_data.get('date') or format_date
-        folder = expense_data.get('folder', 'Unknown')
-        concept = expense_data.get('concept', '')
+        date_for_drive = expense_data.date or format_date
+        folder = expense_data.folder
+        concept = expense_data.concept
     
         link_drive = ""
 
             
         if file_bytes and mimetype:
             ext = ".pdf" if "pdf" in mimetype else ".jpg"
-            
+
             clean_concept = str(concept).replace(" ", "_")[:20] # Limitamos largo
             file_name = f"{folder}_{clean_concept}_{str(timestamp).replace(' ', '_').replace(':', '-')}{ext}"
 
-            link_drive = google_service.save_file(file_bytes, timestamp, file_name, mimetype)
+            # Upload in the pool and tell the user we are on it while the
+            # file is in flight; only the Sheets row needs the Drive link.
+            upload_future = _executor.submit(
+                google_service.save_file, file_bytes, timestamp, file_name, mimetype
+            )
+            _executor.submit(
+                whatsapp_service.send_whatsapp_message, sender_phone, "📝 Procesando tu recibo..."
+            )
+            link_drive = upload_future.result()
 
         # Prepare the row for Google Sheets
         # Date	Concept	Amount	Currency	Category	Subcategory	Sender	Timestamp
@@ -116,36 +186,45 @@ def handle_ai_response(
         row_to_add = [
             date_for_drive,         # C: Fecha de la factura (extraída por IA)
             concept,                # D: Concepto
-            expense_data.get('amount', ''),
-            expense_data.get('currency', ''),
-            expense_data.get('category', ''),
-            expense_data.get('subcategory', ''),
+            expense_data.amount if expense_data.amount is not None else '',
+            expense_data.currency,
+            expense_data.category,
+            expense_data.subcategory,
             sender_phone,           # B: Quién lo envió
             timestamp,              # A: Cuándo se envió el mensaje
             link_drive              # I: Link directo al archivo
         ]
         logging.info(f"row_to_add {row_to_add}")
 
-        
-        google_service.add_row_to_sheet(row_to_add)
-        
+
+        # The Sheets append does not depend on the confirmation message, so
+        # both run concurrently and we only wait once at the end.
+        sheet_future = _executor.submit(google_service.add_row_to_sheet, row_to_add)
+
         # Optionally, send a success message via WhatsApp
         logging.info(f"✅ Transacción registrada: {concept} - {folder}")
-        print(f"✅ Transacción registrada: {concept} - {folder}")
 
         mensaje = (
                 f"📝 ¡Listo! Se creó exitosamente una entrada con concepto '{concept}', "
                 f"fecha {date_for_drive}, "
-                f"valor {expense_data.get('amount', 0.0)} {expense_data.get('currency', '')}, "
-                f"categoría '{expense_data.get('category', '')}', "
-                f"subcategoría '{expense_data.get('subcategory', '')}'. "
+                f"valor {expense_data.amount or 0.0} {expense_data.currency}, "
+                f"categoría '{expense_data.category}', "
+                f"subcategoría '{expense_data.subcategory}'. "
                 )
 
-        whatsapp_service.send_whatsapp_message(sender_phone, mensaje)
+        send_future = _executor.submit(whatsapp_service.send_whatsapp_message, sender_phone, mensaje)
+
+        sheet_saved = sheet_future.result()
+        send_future.result()
+        if not sheet_saved:
+            logging.error("Sheets append failed; the content will not be marked as processed.")
+        return bool(sheet_saved)
 
-    except json.JSONDecodeError:
+    except ValueError:
         logging.error(f"Could not parse AI response as JSON: {ai_response}")
         whatsapp_service.send_whatsapp_message(sender_phone, "❌ Could not parse AI response as JSON")
+        return False
     except Exception as e:
         logging.error(f"An error occurred during data preparation: {e}")
-        whatsapp_service.send_whatsapp_message(sender_phone, "❌ An error occurred during data preparation:")
\ No newline at end of file
+        whatsapp_service.send_whatsapp_message(sender_phone, "❌ An error occurred during data preparation:")
+        return False
\ No newline at end of file
@@ -0,0 +1,116 @@
+"""Deferred receipt extraction through the Gemini Batch API.
+
+Batch jobs run at roughly half the token cost of interactive calls but can
+take minutes to hours to complete, so this path is not wired into the
+webhook: chat users keep getting their confirmation from the synchronous
+path. It exists for non-interactive workloads — backfills, reprocessing a
+day of receipts — where latency does not matter and the discount does.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+from google.genai import types
+
+from . import ai_service
+
+_POLL_INTERVAL_SECONDS = 30.0
+_TERMINAL_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED"}
+
+def submit_batch(prompts: List[Tuple[str, str]]) -> Optional[str]:
+    """Submits (key, text) prompts as one batch job and returns the job name.
+
+    Each entry becomes one JSONL request line carrying the same system
+    instruction the interactive path uses, so both paths extract identical
+    fields.
+    """
+    client = ai_service._get_client()
+    if not client:
+        logging.error("Cannot submit a batch job because the Gemini client is not available.")
+        return None
+    if not prompts:
+        return None
+
+    # The output shape lives in ai_service._RESPONSE_SCHEMA, not in the
+    # system instruction, so the schema must ride along in every batch
+    # request too — otherwise results come back with unconstrained field
+    # names and ExpenseData.from_dict silently defaults everything.
+    generation_config = {
+        "response_mime_type": "application/json",
+        "response_schema": ai_service._RESPONSE_SCHEMA.model_dump(
+            mode="json", exclude_none=True
+        ),
+    }
+
+    jsonl_path = None
+    try:
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as handle:
+            for key, text in prompts:
+                handle.write(json.dumps({
+                    "key": key,
+                    "request": {
+                        "contents": [{"role": "user", "parts": [{"text": text}]}],
+                        "system_instruction": {"parts": [{"text": ai_service.SYSTEM_INSTRUCTION}]},
+                        "generation_config": generation_config,
+                    },
+                }) + "\n")
+            jsonl_path = handle.name
+
+        uploaded = client.files.upload(
+            file=jsonl_path,
+            config=types.UploadFileConfig(mime_type="jsonl"),
+        )
+        job = client.batches.create(
+            model=ai_service._MODEL_NAME,
+            src=uploaded.name,
+            config=types.CreateBatchJobConfig(display_name="leoai-receipt-batch"),
+        )
+        logging.info(f"Submitted Gemini batch job {job.name} with {len(prompts)} requests.")
+        return job.name
+    except Exception as e:
+        logging.error(f"Could not submit Gemini batch job: {e}")
+        return None
+    finally:
+        # The JSONL only exists to feed files.upload; drop it whether or
+        # not the submission succeeded.
+        if jsonl_path:
+            try:
+                os.unlink(jsonl_path)
+            except OSError:
+                pass
+
+def wait_for_batch(job_name: str, timeout_seconds: float = 3600.0) -> Optional[Dict[str, str]]:
+    """Polls a batch job until it finishes and returns {key: response_text}."""
+    client = ai_service._get_client()
+    if not client or not job_name:
+        return None
+
+    try:
+        deadline = time.monotonic() + timeout_seconds
+        job = client.batches.get(name=job_name)
+        while job.state.name not in _TERMINAL_STATES:
+            if time.monotonic() > deadline:
+                logging.warning(f"Timed out waiting for Gemini batch job {job_name}.")
+                return None
+            time.sleep(_POLL_INTERVAL_SECONDS)
+            job = client.batches.get(name=job_name)
+
+        if job.state.name != "JOB_STATE_SUCCEEDED":
+            logging.error(f"Gemini batch job {job_name} ended in state {job.state.name}.")
+            return None
+
+        raw = client.files.download(file=job.dest.file_name)
+        results = {}
+        for line in raw.decode("utf-8").splitlines():
+            entry = json.loads(line)
+            candidates = (entry.get("response") or {}).get("candidates") or [{}]
+            parts = (candidates[0].get("content") or {}).get("parts") or [{}]
+            results[entry.get("key")] = parts[0].get("text")
+        return results
+    except Exception as e:
+        logging.error(f"Error while waiting for Gemini batch job {job_name}: {e}")
+        return None
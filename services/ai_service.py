@@ -1,12 +1,196 @@
 """Handles all interactions with the Gemini AI model."""
 
+import asyncio
+import hashlib
+import io
 import logging
-from typing import Optional, List
+import random
+import time
+from collections import OrderedDict
+from typing import Final, Optional, List, Tuple
 
 from google import genai
+from google.genai import errors as genai_errors
 from google.genai import types
 
 from .secrets import get_secret # Import our secret helper
+from config import REDIS_URL
+
+# Same C-accelerated JSON fallback pattern as routes.py and the
+# orchestrator; with response_mime_type set the model returns pure JSON, so
+# no fence-stripping is needed before parsing.
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+    _json_loads = json.loads
+
+# Response cache: identical (text, file) prompts skip the model call
+# entirely. A small in-process LRU answers first, backed by Redis so all
+# workers share hits (e.g. when Meta redelivers or a user resends a receipt).
+try:
+    import redis
+    _redis_cache = redis.Redis.from_url(REDIS_URL)
+except Exception as e:
+    logging.warning(f"Redis is not available for the Gemini response cache: {e}")
+    _redis_cache = None
+
+_response_cache: "OrderedDict[str, str]" = OrderedDict()
+_RESPONSE_CACHE_MAX = 256
+_RESPONSE_CACHE_TTL_SECONDS = 86400
+
+def _is_cacheable_response(response_text: str) -> bool:
+    """Only cache successful extractions.
+
+    Pinning a valid_expense=false answer for 24h would keep rejecting a user
+    who resends the same receipt with better context.
+    """
+    try:
+        return bool(_json_loads(response_text).get('valid_expense'))
+    except (ValueError, AttributeError):
+        return False
+
+def _response_cache_key(text: str, file_bytes: Optional[bytes], mimetype: Optional[str]) -> str:
+    digest = hashlib.sha256()
+    digest.update((text or "").encode("utf-8"))
+    if file_bytes:
+        digest.update(file_bytes)
+    if mimetype:
+        digest.update(mimetype.encode("utf-8"))
+    return f"gemini:resp:{digest.hexdigest()}"
+
+def _response_cache_get(key: str) -> Optional[str]:
+    if key in _response_cache:
+        _response_cache.move_to_end(key)
+        return _response_cache[key]
+    if _redis_cache is not None:
+        try:
+            cached = _redis_cache.get(key)
+            if cached is not None:
+                return cached.decode("utf-8")
+        except Exception as e:
+            logging.warning(f"Redis response cache read failed: {e}")
+    return None
+
+def _response_cache_put(key: str, value: str) -> None:
+    _response_cache[key] = value
+    _response_cache.move_to_end(key)
+    while len(_response_cache) > _RESPONSE_CACHE_MAX:
+        _response_cache.popitem(last=False)
+    if _redis_cache is not None:
+        try:
+            _redis_cache.set(key, value, ex=_RESPONSE_CACHE_TTL_SECONDS)
+        except Exception as e:
+            logging.warning(f"Redis response cache write failed: {e}")
+
+# The extraction prompt never changes, so it is built once at import time
+# together with the request config instead of per call.
+SYSTEM_INSTRUCTION: Final[str] = (
+    "Act as a Senior Financial Assistant. From the user's message and/or image, extract financial transaction data. "
+    "Analyze the image (like a receipt or invoice) to find details. Use the text for context. "
+    "Folder rules: MUST be one of ['Salitre', 'Tramonte', 'Villa', 'Manuela Sancho']. Infer the folder from context. If uncertain, use 'Unknown'. "
+    "- If the folder cannot be confidently determined, set 'folder' to 'Unknown'. "
+    "Date field rule: "
+    "The date field must be formatted as YYYY-MM-DD (e.g., 2026-03-01)."
+    "If the entry refers to an expense for a specific month (e.g., March), use the first day of that month (e.g., 2026-03-01)."
+    "Currency field rule: "
+    "The currency field must use the ISO 4217 three-letter currency code format (e.g., EUR, COP)."
+    "Category rules:"
+    "Assign the most appropriate category based on the nature of the expense or income."
+    "Use only the following predefined categories list: ['Vivienda', 'Alimentación y Hogar', 'Mascotas', 'Ocio', 'Salud y Bienestar', 'Deuda', 'Gasto Financiero', 'Legal', 'Transferencias', 'Familia', 'Ahorro', 'Otros']."
+    "Map subcategories according to the following logic:"
+    "Vivienda: Includes Hipoteca, Renta, Administración, Servicios."
+    "Alimentación y Hogar: Includes Mercado, Glovo."
+    "Mascotas: Includes Alimentación, Seguro, Otros."
+    "Ocio: Includes Netflix, Spotify,Prime."
+    "Salud y Bienestar: Includes Gym, Seguro Médico."
+    "Deuda: Includes Pago Tarjeta, Crédito Libre Inversión."
+    "Gasto Financiero: Includes Seguro de vida"
+    "Legal: Includes Tramites nacionalidad."
+    "Transferencias: Includes envío a Colombia"
+    "Familia: Includes Madre"
+    "Ahorro: Includes Jubilación, fondos de reserva."
+    "Otros: Use only for others"
+    "Validation rules: "
+    "- If the message/image is NOT a valid financial expense or lacks essential data (concept/amount), set 'valid_expense' to false and 'message' to an explanation of what is missing. Set all other fields to null. "
+    "- If it is a valid expense, set 'valid_expense' to true and 'message' to 'Success'. "
+    "- If any field is missing from the message, infer it when possible or use null. "
+)
+
+# The output shape is enforced server-side via response_schema instead of
+# free-text instructions, which shrinks the prompt and guarantees parseable
+# JSON.
+_RESPONSE_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        "valid_expense": types.Schema(type=types.Type.BOOLEAN),
+        "message": types.Schema(type=types.Type.STRING, nullable=True),
+        "concept": types.Schema(type=types.Type.STRING, nullable=True),
+        "amount": types.Schema(type=types.Type.NUMBER, nullable=True),
+        "category": types.Schema(type=types.Type.STRING, nullable=True),
+        "subcategory": types.Schema(type=types.Type.STRING, nullable=True),
+        "currency": types.Schema(type=types.Type.STRING, nullable=True),
+        "date": types.Schema(type=types.Type.STRING, nullable=True),
+        "folder": types.Schema(type=types.Type.STRING, nullable=True),
+    },
+    required=["valid_expense", "message"],
+)
+
+_MODEL_NAME = "gemini-2.5-flash"
+
+_generate_config = types.GenerateContentConfig(
+    system_instruction=SYSTEM_INSTRUCTION,
+    response_mime_type="application/json",
+    response_schema=_RESPONSE_SCHEMA,
+)
+
+# Explicit context cache: the system instruction is uploaded to Gemini once
+# and referenced by name, so its tokens are not resent (or rebilled at full
+# price) on every request. Recreated shortly before the server-side TTL
+# expires; any failure falls back to the inline config above.
+_CONTEXT_CACHE_TTL = "3600s"
+_CONTEXT_CACHE_REFRESH_SECONDS = 3300.0
+_context_cache = {"config": None, "created": 0.0, "unavailable": False}
+
+def _get_generate_config(client) -> types.GenerateContentConfig:
+    """Returns the request config, preferring the explicit context cache."""
+    if _context_cache["unavailable"]:
+        return _generate_config
+
+    now = time.monotonic()
+    if _context_cache["config"] is not None and now - _context_cache["created"] < _CONTEXT_CACHE_REFRESH_SECONDS:
+        return _context_cache["config"]
+
+    try:
+        cache = client.caches.create(
+            model=_MODEL_NAME,
+            config=types.CreateCachedContentConfig(
+                system_instruction=SYSTEM_INSTRUCTION,
+                ttl=_CONTEXT_CACHE_TTL,
+                display_name="leoai-expense-system-instruction",
+            ),
+        )
+        _context_cache["config"] = types.GenerateContentConfig(
+            response_mime_type="application/json",
+            response_schema=_RESPONSE_SCHEMA,
+            cached_content=cache.name,
+        )
+        _context_cache["created"] = now
+        logging.info(f"Created Gemini context cache {cache.name}.")
+        return _context_cache["config"]
+    except Exception as e:
+        # Typically the instruction is below the minimum cacheable token
+        # count for the model; keep sending it inline and stop retrying.
+        logging.warning(f"Gemini context cache unavailable, sending the system instruction inline: {e}")
+        _context_cache["unavailable"] = True
+        return _generate_config
+
+# Fallback prompt for attachments without caption; the Part is read-only so
+# one instance is shared across requests.
+_DEFAULT_PROMPT_PART = types.Part.from_text(
+    text="Analiza este documento y extrae la información financiera."
+)
 
 # --- Gemini AI Model Initialization ---
 
@@ -33,13 +217,118 @@ def initialize_gemini():
     logging.info("GEMINI_API_KEY found. Configuring Gemini...")
     
     try:
-        client = genai.Client(api_key=api_key)
+        # HTTP/2 multiplexes concurrent model calls over one TLS connection;
+        # when the h2 extra is missing, fall back to the default transport.
+        try:
+            client = genai.Client(
+                api_key=api_key,
+                http_options=types.HttpOptions(
+                    client_args={"http2": True},
+                    async_client_args={"http2": True},
+                ),
+            )
+        except Exception as e:
+            logging.warning(f"HTTP/2 transport unavailable for Gemini, using the default: {e}")
+            client = genai.Client(api_key=api_key)
         logging.info("Gemini client initialized successfully.")
         return client
     except Exception as e:
         logging.error(f"An error occurred during Gemini client initialization: {e}")
         return None
 
+# Receipt photos from phones are typically 2-5 MB; Gemini reads them at tile
+# resolution anyway, so anything above the threshold is downscaled and
+# re-encoded before the request. The original bytes still go to Drive intact.
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+_SHRINK_THRESHOLD_BYTES = 300_000
+_SHRINK_MAX_LONG_EDGE = 1568
+
+def _shrink_image(file_bytes: bytes, mimetype: str) -> Tuple[bytes, str]:
+    """Downscales a large photo for the model call; returns (bytes, mimetype)."""
+    if Image is None or not mimetype.startswith("image/"):
+        return file_bytes, mimetype
+    if len(file_bytes) <= _SHRINK_THRESHOLD_BYTES:
+        return file_bytes, mimetype
+
+    try:
+        image = Image.open(io.BytesIO(file_bytes))
+        image.thumbnail((_SHRINK_MAX_LONG_EDGE, _SHRINK_MAX_LONG_EDGE), Image.LANCZOS)
+        out = io.BytesIO()
+        image.convert("RGB").save(out, "JPEG", quality=85, optimize=True)
+        shrunk = out.getvalue()
+        logging.info("Downscaled image from %d to %d bytes for Gemini.", len(file_bytes), len(shrunk))
+        return shrunk, "image/jpeg"
+    except Exception as e:
+        logging.warning(f"Could not downscale image, sending the original: {e}")
+        return file_bytes, mimetype
+
+# Attachments are uploaded to the Gemini Files API and referenced by URI,
+# so a receipt re-sent with a different caption costs zero upload bytes and
+# its tokens stay prefix-cacheable server-side. The API keeps uploads for
+# 48h; entries expire a little earlier to stay on the safe side.
+_file_uri_cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+_FILE_URI_CACHE_MAX = 128
+_FILE_URI_TTL_SECONDS = 47 * 3600.0
+
+def _attachment_part(client, file_bytes: bytes, mimetype: str) -> types.Part:
+    """Returns the attachment Part, reusing a Files API URI when possible."""
+    key = hashlib.sha256(file_bytes).hexdigest()
+    cached = _file_uri_cache.get(key)
+    if cached is not None and time.monotonic() - cached[1] < _FILE_URI_TTL_SECONDS:
+        _file_uri_cache.move_to_end(key)
+        return types.Part.from_uri(file_uri=cached[0], mime_type=mimetype)
+
+    try:
+        uploaded = client.files.upload(
+            file=io.BytesIO(file_bytes),
+            config=types.UploadFileConfig(mime_type=mimetype),
+        )
+        _file_uri_cache[key] = (uploaded.uri, time.monotonic())
+        while len(_file_uri_cache) > _FILE_URI_CACHE_MAX:
+            _file_uri_cache.popitem(last=False)
+        return types.Part.from_uri(file_uri=uploaded.uri, mime_type=mimetype)
+    except Exception as e:
+        logging.warning(f"Files API upload failed, sending the attachment inline: {e}")
+        return types.Part.from_bytes(data=file_bytes, mime_type=mimetype)
+
+def _build_contents(client, text: str, file_bytes: Optional[bytes] = None, mimetype: Optional[str] = None) -> List[types.Content]:
+    """Builds the request contents shared by the sync and async entrypoints."""
+    parts = []
+
+    if file_bytes and mimetype:
+        file_bytes, mimetype = _shrink_image(file_bytes, mimetype)
+        parts.append(_attachment_part(client, file_bytes, mimetype))
+
+    parts.append(types.Part.from_text(text=text) if text else _DEFAULT_PROMPT_PART)
+
+    return [types.Content(role="user", parts=parts)]
+
+# Transient 429/5xx from Gemini previously bubbled up and dropped the
+# user's message; retry them with exponential, jittered backoff the same
+# way google_service handles the Sheets quota.
+_GEMINI_RETRY_MAX_ATTEMPTS = 3
+_GEMINI_RETRY_BASE_DELAY_SECONDS = 0.5
+
+def _generate_with_backoff(client, contents, config):
+    """Calls generate_content, retrying rate limits and server errors."""
+    for attempt in range(_GEMINI_RETRY_MAX_ATTEMPTS):
+        try:
+            return client.models.generate_content(
+                model=_MODEL_NAME, contents=contents, config=config
+            )
+        except genai_errors.APIError as e:
+            code = getattr(e, 'code', None)
+            retryable = code == 429 or (code is not None and code >= 500)
+            if not retryable or attempt == _GEMINI_RETRY_MAX_ATTEMPTS - 1:
+                raise
+            delay = _GEMINI_RETRY_BASE_DELAY_SECONDS * (2 ** attempt) + random.uniform(0, 0.5)
+            logging.warning("Gemini returned %s. Retrying in %.1fs...", code, delay)
+            time.sleep(delay)
+
 def process_with_gemini(text: str, file_bytes: Optional[bytes] = None, mimetype: Optional[str] = None) -> Optional[str]:
     """Processes the given text and/or image using the Gemini model."""
     client = _get_client()
@@ -47,76 +336,74 @@ def process_with_gemini(text: str, file_bytes: Optional[bytes] = None, mimetype:
     if not client:
         logging.error("Cannot process content because the Gemini client is not available.")
         return None
-    
-    try:
-        system_instruction = (
-            "Act as a Senior Financial Assistant. From the user's message and/or image, extract financial transaction data "
-            "and return it as a JSON object with fields: "
-            "{'valid_expense': bool, 'message': str, 'concept': str, 'amount': float, 'category': str, 'subcategory': str, 'currency': str, 'date': str, 'folder': str}. "
-            "Analyze the image (like a receipt or invoice) to find details. Use the text for context. "
-            "Folder rules: MUST be one of ['Salitre', 'Tramonte', 'Villa', 'Manuela Sancho']. Infer the folder from context. If uncertain, use 'Unknown'. "
-            "- If the folder cannot be confidently determined, set 'folder' to 'Unknown'. "
-            "Date field rule: "
-            "The date field must be formatted as YYYY-MM-DD (e.g., 2026-03-01)."
-            "If the entry refers to an expense for a specific month (e.g., March), use the first day of that month (e.g., 2026-03-01)."
-            "Currency field rule: "
-            "The currency field must use the ISO 4217 three-letter currency code format (e.g., EUR, COP)."
-            "Category rules:"
-            "Assign the most appropriate category based on the nature of the expense or income."
-            "Use only the following predefined categories list: ['Vivienda', 'Alimentación y Hogar', 'Mascotas', 'Ocio', 'Salud y Bienestar', 'Deuda', 'Gasto Financiero', 'Legal', 'Transferencias', 'Familia', 'Ahorro', 'Otros']."
-            "Map subcategories according to the following logic:"
-            "Vivienda: Includes Hipoteca, Renta, Administración, Servicios."
-            "Alimentación y Hogar: Includes Mercado, Glovo."
-            "Mascotas: Includes Alimentación, Seguro, Otros."
-            "Ocio: Includes Netflix, Spotify,Prime."
-            "Salud y Bienestar: Includes Gym, Seguro Médico."
-            "Deuda: Includes Pago Tarjeta, Crédito Libre Inversión."
-            "Gasto Financiero: Includes Seguro de vida"
-            "Legal: Includes Tramites nacionalidad."
-            "Transferencias: Includes envío a Colombia"
-            "Familia: Includes Madre"
-            "Ahorro: Includes Jubilación, fondos de reserva."
-            "Otros: Use only for others"
-            "Validation rules: "
-            "- If the message/image is NOT a valid financial expense or lacks essential data (concept/amount), set 'valid_expense' to false and 'message' to an explanation of what is missing. Set all other fields to null. "
-            "- If it is a valid expense, set 'valid_expense' to true and 'message' to 'Success'. "
-            "Output rules: "
-            "- Only return the JSON object, no conversation. "
-            "- Do not include explanations, comments, or conversational text. "
-            "- If any field is missing from the message, infer it when possible or use null. "
-        )
 
-        parts = []
+    # Normalize surrounding whitespace so structurally identical prompts
+    # share a local cache key and an implicit-cache prefix server-side.
+    text = (text or "").strip()
+
+    cache_key = _response_cache_key(text, file_bytes, mimetype)
+    cached = _response_cache_get(cache_key)
+    if cached is not None:
+        logging.info("Returning cached Gemini response.")
+        return cached
+
+    try:
+        # Lazy %-formatting: the argument work is skipped entirely when the
+        # level is disabled, and the full response is only stringified (a
+        # whole-proto repr) under DEBUG.
+        logging.info("Sending prompt to Gemini len=%d has_file=%s", len(text), bool(file_bytes))
 
-        if file_bytes and mimetype:
-            parts.append(
-                types.Part.from_bytes(
-                    data=file_bytes,
-                    mime_type=mimetype
-                )
-            )
-        
-        prompt_text = text if text else "Analiza este documento y extrae la información financiera."
-        parts.append(types.Part.from_text(text=prompt_text))
-        #prompt_text = f"Extract the financial data from this document/image/text and merge with information from {text}"
-        #parts.append(types.Part.from_text(text=text if text else "Analiza este documento."))
-        
-        logging.info(f"Sending prompt to Gemini with text: '{text}' and an image: {'Yes' if file_bytes else 'No'}")
-        
         # Use a multimodal model
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            #contents=text, #esta funciona
-            contents=[
-                types.Content(role="user", parts=parts)
-            ],
-            config=types.GenerateContentConfig(
-                system_instruction=system_instruction,
-                response_mime_type="application/json"
-            ),
+        response = _generate_with_backoff(
+            client,
+            contents=_build_contents(client, text, file_bytes, mimetype),
+            config=_get_generate_config(client),
         )
-        logging.info(f"gemini response {response}")
+        logging.debug("gemini response %s", response)
 
+        if response.text and _is_cacheable_response(response.text):
+            _response_cache_put(cache_key, response.text)
+        return response.text
+    except Exception as e:
+        logging.error(f"An error occurred while communicating with Gemini: {e}")
+        return None
+
+# Bounds in-flight async Gemini calls so a burst of concurrent webhooks
+# cannot blow through the model's rate limits.
+_ASYNC_MAX_IN_FLIGHT = 16
+_gemini_semaphore = asyncio.Semaphore(_ASYNC_MAX_IN_FLIGHT)
+
+async def process_with_gemini_async(text: str, file_bytes: Optional[bytes] = None, mimetype: Optional[str] = None) -> Optional[str]:
+    """Async variant of process_with_gemini using the client's aio surface.
+
+    Useful from async callers (e.g. asyncio.gather over several messages);
+    the webhook itself keeps handing work to the task queue.
+    """
+    client = _get_client()
+
+    if not client:
+        logging.error("Cannot process content because the Gemini client is not available.")
+        return None
+
+    text = (text or "").strip()
+
+    cache_key = _response_cache_key(text, file_bytes, mimetype)
+    cached = _response_cache_get(cache_key)
+    if cached is not None:
+        logging.info("Returning cached Gemini response.")
+        return cached
+
+    try:
+        logging.info("Sending async prompt to Gemini len=%d has_file=%s", len(text), bool(file_bytes))
+
+        async with _gemini_semaphore:
+            response = await client.aio.models.generate_content(
+                model=_MODEL_NAME,
+                contents=_build_contents(client, text, file_bytes, mimetype),
+                config=_get_generate_config(client),
+            )
+        if response.text and _is_cacheable_response(response.text):
+            _response_cache_put(cache_key, response.text)
         return response.text
     except Exception as e:
         logging.error(f"An error occurred while communicating with Gemini: {e}")
@@ -1,5 +1,6 @@
 
 import logging
+import time
 from typing import Optional, Tuple
 
 from . import ai_service
@@ -10,53 +11,44 @@ from . import whatsapp_service
 from utils.errors import UnAuthorizedUserException
 from utils.errors import AIProccesingException
 
-def proccess_whatsapp_message_with_ai(data: dict):
-    """Main handler for incoming WhatsApp messages."""
-    message_type = message_data.get('type')
-
-
 def handle_text_message(message_data: dict):
     """Text handler for incoming WhatsApp messages."""
+    message_text = message_data.get('text', {}).get('body', '')
     try:
         logging.debug("text message received")
-        message_text = message_data['text']['body']
         return ai_service.process_with_gemini(text=message_text)
     except Exception as e:
         logging.error(f"An error occurred while processing the message: {e}")
         raise AIProccesingException(message=message_text)
 
 def handle_message_with_attachement(message_data: dict, message_type: str):
-    """Image handler for incoming WhatsApp messages."""
+    """Image/document handler for incoming WhatsApp messages."""
+    caption = ''
     try:
-        logging.info("image message received")
+        logging.info("media message received")
 
         # Extraemos la info dinámicamente según sea imagen o documento
-        media_info = message_data[message_type] 
+        media_info = message_data[message_type]
         media_id = media_info['id']
         mimetype = media_info['mime_type'] # <--- VITAL: capturamos el tipo real
         caption = media_info.get('caption', '')
         logging.info(f"Received {message_type} ({mimetype}) with caption: '{caption}'")
 
-        return process_media_message(media_id, caption, timestamp, message_type)
+        return process_media_message(media_id, caption, message_type, mimetype)
 
     except Exception as e:
-        ogging.error(f"An error occurred while processing the message: {e}")
-        raise AIProccesingException(message=message_text)
-
-
-
-def handle_document_message(data: dict):
-    """Document handler for incoming WhatsApp messages."""
+        logging.error(f"An error occurred while processing the message: {e}")
+        raise AIProccesingException(message=caption)
 
 
 def process_media_message(
-    media_id: str, 
-    caption: str, 
-    timestamp: str, 
-    message_type: str # 'image' o 'document'
-) -> Tuple[Optional[str], Optional[bytes]]:
+    media_id: str,
+    caption: str,
+    message_type: str, # 'image' o 'document'
+    mimetype: str
+) -> Tuple[Optional[str], Optional[bytes], Optional[str]]:
     """
-    Procesa un archivo (imagen o PDF) coordinando la descarga de WhatsApp 
+    Procesa un archivo (imagen o PDF) coordinando la descarga de WhatsApp
     y el análisis de Gemini.
     """
     # 1. Obtener la URL del archivo (WhatsApp usa la misma lógica para ambos)
@@ -64,24 +56,42 @@ def process_media_message(
     if not media_url:
         # Consider sending a WhatsApp message back to the user
         logging.error(f"No se pudo obtener la URL para el {message_type}")
-        return None, None
+        return None, None, None
 
     # 2. Descargar los bytes (valido para jpg, png, pdf, etc.)
     file_bytes = whatsapp_service.download_media_content(media_url)
     if not file_bytes:
         # Consider sending a WhatsApp message back to the user
         logging.error(f"No se pudieron descargar los bytes del {message_type}")
-        return None, None
-    
-    # 3. Mandar a Gemini
-    # Gemini 1.5 detecta automáticamente si los bytes son imagen o PDF
+        return None, None, None
+
+    # 3. Mandar a Gemini con el mimetype real del archivo
     logging.info(f"Enviando {message_type} a Gemini para análisis...")
     ai_response = ai_service.process_with_gemini(
-        text=caption, 
-        file_bytes=file_bytes
+        text=caption,
+        file_bytes=file_bytes,
+        mimetype=mimetype
     )
-        
-    return ai_response, file_bytes
+
+    return ai_response, file_bytes, mimetype
+
+# La hoja 'Usuarios' cambia muy poco: se refresca como mucho una vez por
+# minuto y, si el refresco falla, se sigue usando la lista anterior para que
+# un 5xx de Google no bloquee a los usuarios autorizados.
+_users_cache = {"ts": 0.0, "users": frozenset()}
+_USERS_CACHE_TTL_SECONDS = 60.0
+
+def _get_allowed_users() -> frozenset:
+    """Returns the cached allow-list, refreshing it when the TTL expires."""
+    now = time.time()
+    if now - _users_cache["ts"] > _USERS_CACHE_TTL_SECONDS:
+        users = google_service.get_authorized_users()
+        if users:
+            _users_cache["users"] = frozenset(users)
+        elif _users_cache["users"]:
+            logging.warning("No se pudo refrescar la lista de usuarios. Usando la copia anterior.")
+        _users_cache["ts"] = now
+    return _users_cache["users"]
 
 def validate_allowed_users(sender_phone: str) -> None:
     """
@@ -93,7 +103,7 @@ def validate_allowed_users(sender_phone: str) -> None:
     Raises:
         UnAuthorizedUserException: Si el usuario no está en la lista de autorizados.
     """
-    allowed_users = google_service.get_authorized_users()
+    allowed_users = _get_allowed_users()
 
     if sender_phone not in allowed_users:
         logging.warning(
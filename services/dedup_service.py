@@ -0,0 +1,139 @@
+"""Deduplicates incoming WhatsApp messages across workers.
+
+Meta retries webhook deliveries, so the same message can arrive more than
+once; a Redis SETNX on the message ID makes sure only the first delivery is
+processed.
+"""
+
+import hashlib
+import logging
+from typing import Optional
+
+from config import REDIS_URL
+
+try:
+    import redis
+    _redis_client = redis.Redis.from_url(REDIS_URL)
+except Exception as e:
+    logging.warning(f"Redis is not available for deduplication: {e}")
+    _redis_client = None
+
+# How long a message ID stays marked as seen. Meta stops retrying well
+# before this window closes.
+DEDUP_TTL_SECONDS = 600
+
+# An in-flight claim is deliberately short: it only has to fence off a
+# concurrent double-delivery. If the worker crashes mid-task, the claim
+# expires and the broker's redelivery (acks_late) gets to process the
+# message for real instead of being dropped as a duplicate.
+IN_PROGRESS_TTL_SECONDS = 120
+
+# In-process fallback when Redis is unreachable (single-worker dedup only).
+_seen_ids: set = set()
+_SEEN_IDS_MAX = 1000
+
+def is_duplicate_message(message_id: str) -> bool:
+    """Returns True if this ID was already processed or is being processed.
+
+    A False return claims the ID for this worker; the caller must report
+    completion via mark_message_processed so the claim becomes permanent.
+    """
+    if not message_id:
+        return False
+
+    if _redis_client is not None:
+        try:
+            if _redis_client.exists(f"wa:msg:{message_id}"):
+                return True
+            # SET with nx=True returns None when the key already exists,
+            # which means another delivery of this message won the race.
+            was_claimed = _redis_client.set(
+                f"wa:msg:inflight:{message_id}", 1, nx=True, ex=IN_PROGRESS_TTL_SECONDS
+            )
+            return not was_claimed
+        except Exception as e:
+            logging.warning(f"Redis dedup check failed, falling back to in-memory: {e}")
+
+    if message_id in _seen_ids:
+        return True
+    if len(_seen_ids) >= _SEEN_IDS_MAX:
+        _seen_ids.clear()
+    _seen_ids.add(message_id)
+    return False
+
+def mark_message_processed(message_id: str) -> None:
+    """Makes the dedup marker permanent once handling finished."""
+    if not message_id or _redis_client is None:
+        return
+
+    try:
+        pipe = _redis_client.pipeline()
+        pipe.set(f"wa:msg:{message_id}", 1, ex=DEDUP_TTL_SECONDS)
+        pipe.delete(f"wa:msg:inflight:{message_id}")
+        pipe.execute()
+    except Exception as e:
+        logging.warning(f"Redis dedup write failed: {e}")
+
+# Content-level dedup: the message-ID check above catches Meta redeliveries,
+# but a user re-sending the same receipt gets a fresh message ID. Keying on
+# (sender, content hash) catches those too, so the pipeline does not write a
+# second sheet row or Drive copy for identical content. The key is only
+# written via mark_content_processed once the pipeline actually saved the
+# expense, so a failed attempt never blocks the user's retry.
+CONTENT_DEDUP_TTL_SECONDS = 600
+
+def _content_key(sender_phone: str, text: str, file_bytes: Optional[bytes]) -> str:
+    digest = hashlib.sha256()
+    digest.update((text or "").encode("utf-8"))
+    if file_bytes:
+        digest.update(file_bytes)
+    return f"wa:content:{sender_phone}:{digest.hexdigest()}"
+
+def is_duplicate_content(sender_phone: str, text: str, file_bytes: Optional[bytes]) -> bool:
+    """Returns True when this sender's identical content was already processed."""
+    if not sender_phone or (not text and not file_bytes) or _redis_client is None:
+        return False
+
+    try:
+        return _redis_client.exists(_content_key(sender_phone, text, file_bytes)) > 0
+    except Exception as e:
+        logging.warning(f"Redis content dedup check failed, allowing message: {e}")
+        return False
+
+def mark_content_processed(sender_phone: str, text: str, file_bytes: Optional[bytes]) -> None:
+    """Records content as processed after its expense was actually saved."""
+    if not sender_phone or (not text and not file_bytes) or _redis_client is None:
+        return
+
+    try:
+        _redis_client.set(
+            _content_key(sender_phone, text, file_bytes), 1, ex=CONTENT_DEDUP_TTL_SECONDS
+        )
+    except Exception as e:
+        logging.warning(f"Redis content dedup write failed: {e}")
+
+# Per-sender budget: a flood from one number (or a retry storm) gets dropped
+# before it reaches Gemini and the Google APIs.
+RATE_LIMIT_MAX_MESSAGES = 20
+RATE_LIMIT_WINDOW_SECONDS = 60
+
+def is_rate_limited(sender_phone: str) -> bool:
+    """Returns True when the sender exceeded the per-minute message budget."""
+    if not sender_phone or _redis_client is None:
+        return False
+
+    try:
+        key = f"wa:rate:{sender_phone}"
+        # INCR and EXPIRE travel in one pipeline so a crash between them
+        # cannot leave the counter without a TTL, which would lock the
+        # sender out permanently once it crossed the budget. NX keeps the
+        # window fixed: only the first message of a window arms the TTL,
+        # so steady senders still reset every RATE_LIMIT_WINDOW_SECONDS.
+        pipe = _redis_client.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, RATE_LIMIT_WINDOW_SECONDS, nx=True)
+        count, _ = pipe.execute()
+        return count > RATE_LIMIT_MAX_MESSAGES
+    except Exception as e:
+        logging.warning(f"Redis rate-limit check failed, allowing message: {e}")
+        return False
@@ -1,36 +1,52 @@
 """Handles all interactions with Google services like Sheets and Drive."""
 
+import io
 import os
 import logging
-import gspread
-import io
 import json
 import datetime
+import threading
+import time
+import random
+import atexit
 from typing import Optional, Tuple
 
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaInMemoryUpload, MediaIoBaseUpload
 
 from google.auth import default
 
 from .secrets import get_secret
 
 # --- Helper for Authentication ---
+
+# Application-default credentials are resolved once per process; every call
+# was re-reading and re-parsing the service-account key. The cached object
+# is long-lived and refreshes its own token, so per-request auth disappears.
+_cached_creds = None
+_creds_lock = threading.Lock()
+
 def _get_google_creds() -> Optional[Tuple[Credentials, str, str]]:
     """Retrieves Google credentials and configuration from Secret Manager."""
-        
+    global _cached_creds
+
     try:
-        scopes = [
-            "https://www.googleapis.com/auth/spreadsheets", 
-            "https://www.googleapis.com/auth/drive"
-        ]
-        creds, project_id = default(scopes=scopes)
-        
+        if _cached_creds is None:
+            with _creds_lock:
+                if _cached_creds is None:
+                    scopes = [
+                        "https://www.googleapis.com/auth/spreadsheets",
+                        "https://www.googleapis.com/auth/drive"
+                    ]
+                    _cached_creds, _ = default(scopes=scopes)
+        creds = _cached_creds
+
         sheet_id = get_secret("GOOGLE_SHEET_ID")
         drive_folder_id = get_secret("GOOGLE_DRIVE_FOLDER_ID")
 
-        if not all([sheet_id, drive_folder_id]):
+        if not sheet_id or not drive_folder_id:
             logging.error("One or more Google secrets are missing from Secret Manager.")
             return None, None, None
 
@@ -42,33 +58,180 @@ def _get_google_creds() -> Optional[Tuple[Credentials, str, str]]:
 
 # --- Google Sheets Service ---
 
-def add_row_to_sheet(data_row: list):
-    """Appends a new row to the configured Google Sheet."""
-    logging.info(f"Apppending row to Google Sheet. {data_row}")
+# Rows are buffered in memory and written with a single append call: each
+# caller flushes inline (so it learns whether its row actually landed) and
+# concurrent callers still coalesce, because whichever thread reaches the
+# flush first drains everything the others buffered.
+_pending_rows: list = []
+_pending_lock = threading.Lock()
+
+# Backoff for the 60 writes/min Sheets quota: retry 429s a couple of times
+# with exponential, jittered delays so concurrent workers do not retry in
+# lock-step.
+_RETRY_MAX_ATTEMPTS = 3
+_RETRY_BASE_DELAY_SECONDS = 1.0
+
+# Cached Sheets discovery client for the write path. values().append with
+# RAW input avoids extra metadata round-trips and server-side value
+# parsing.
+_sheets_service = None
+_services_lock = threading.Lock()
+
+def _get_sheets_service():
+    """Returns a cached Sheets API discovery client."""
+    global _sheets_service
+    if _sheets_service is None:
+        with _services_lock:
+            if _sheets_service is None:
+                creds, _, _ = _get_google_creds()
+                if not creds:
+                    logging.error("Google credentials not available for the Sheets client.")
+                    return None
+                # static_discovery uses the discovery document bundled with
+                # the client library instead of fetching it over the network.
+                _sheets_service = build(
+                    'sheets', 'v4',
+                    credentials=creds,
+                    cache_discovery=False,
+                    static_discovery=True,
+                )
+    return _sheets_service
+
+def _execute_with_backoff(request):
+    """Executes an API request, retrying 429/5xx with jittered backoff."""
+    for attempt in range(_RETRY_MAX_ATTEMPTS):
+        try:
+            return request.execute()
+        except HttpError as e:
+            status = getattr(getattr(e, 'resp', None), 'status', None)
+            retryable = status == 429 or (status is not None and status >= 500)
+            if not retryable or attempt == _RETRY_MAX_ATTEMPTS - 1:
+                raise
+            delay = _RETRY_BASE_DELAY_SECONDS * (2 ** attempt) + random.uniform(0, 1)
+            logging.warning("Google API returned %s. Retrying in %.1fs...", status, delay)
+            time.sleep(delay)
+
+def _append_rows_with_backoff(service, sheet_id: str, rows: list):
+    """Appends rows, retrying rate-limited calls with jittered backoff."""
+    _execute_with_backoff(
+        service.spreadsheets().values().append(
+            spreadsheetId=sheet_id,
+            range="A1",
+            valueInputOption="RAW",
+            insertDataOption="INSERT_ROWS",
+            body={"values": rows},
+        )
+    )
 
-    try:
-        creds, sheet_id, _ = _get_google_creds()
-        if not creds:
-            logging.error("Google Sheet ID or Credentials Path not found in environment variables.")
-            return
-        
-        logging.info("gspread.authorize")
-        gs_client = gspread.authorize(creds)
+def add_row_to_sheet(data_row: list) -> bool:
+    """Writes a row to the configured Google Sheet; True when it landed."""
+    logging.info("Buffering row for Google Sheet. %s", data_row)
+
+    with _pending_lock:
+        _pending_rows.append(data_row)
+
+    return flush_sheet_buffer()
 
-        logging.info("open_by_key")
-        sheet = gs_client.open_by_key(sheet_id).sheet1
+def flush_sheet_buffer() -> bool:
+    """Appends all buffered rows in a single API call; True on success.
 
-        logging.info("append_row")
-        sheet.append_row(data_row)
-        logging.info(f"Successfully added row to Google Sheet: {data_row}")
-    except FileNotFoundError:
-        logging.error(f"Credentials file not found at path: {creds_path}. Make sure the file exists.")
+    An empty buffer counts as success (another caller already drained it).
+    """
+    with _pending_lock:
+        rows = list(_pending_rows)
+        _pending_rows.clear()
+
+    if not rows:
+        return True
+
+    try:
+        service = _get_sheets_service()
+        sheet_id = get_secret("GOOGLE_SHEET_ID")
+        if not service or not sheet_id:
+            return False
+
+        _append_rows_with_backoff(service, sheet_id, rows)
+        logging.info("Successfully added %d row(s) to Google Sheet.", len(rows))
+        return True
     except Exception as e:
-        logging.error(f"An error occurred while writing to Google Sheets: {e}")
-        logging.error("An error occurred while writing to Google Sheets:", exc_info=True)
+        logging.error("An error occurred while writing to Google Sheets: %s", e, exc_info=True)
+        return False
+
+# Backstop: flush anything still buffered when the process exits.
+atexit.register(flush_sheet_buffer)
 
 # --- Google Drive Service ---
 
+# One Drive discovery client per process; building it re-fetches the
+# discovery document and re-wraps the credentials on every call otherwise.
+_drive_service = None
+
+def _drive_view_link(file_id: str) -> Optional[str]:
+    """Builds the shareable view URL from the file ID.
+
+    The URL shape is stable, so asking the API for webViewLink just adds
+    payload to the create response.
+    """
+    if not file_id:
+        return None
+    return f"https://drive.google.com/file/d/{file_id}/view"
+
+def _get_drive_service():
+    """Returns a cached Drive API discovery client."""
+    global _drive_service
+    if _drive_service is None:
+        with _services_lock:
+            if _drive_service is None:
+                creds, _, _ = _get_google_creds()
+                if not creds:
+                    logging.error("Google credentials not available for the Drive client.")
+                    return None
+                _drive_service = build(
+                    'drive', 'v3',
+                    credentials=creds,
+                    cache_discovery=False,
+                    static_discovery=True,
+                )
+    return _drive_service
+
+# WhatsApp media caps out well below this, so uploads are single-shot POSTs;
+# the resumable protocol (extra session-init round trip, chunked PUTs) only
+# kicks in for payloads large enough to be worth restarting mid-transfer.
+_RESUMABLE_THRESHOLD_BYTES = 5 * 1024 * 1024
+_RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024
+
+def _grant_public_read_async(file_id: str):
+    """Grants the anyone/viewer permission in the background.
+
+    The shareable link only needs the file ID, so the caller does not have
+    to wait out a second Drive round trip before replying to the user.
+    """
+    def _grant():
+        try:
+            service = _get_drive_service()
+            if not service:
+                return
+            service.permissions().create(
+                fileId=file_id,
+                body={'type': 'anyone', 'role': 'viewer'}
+            ).execute()
+        except Exception as e:
+            logging.error(f"Error granting public read on Drive file {file_id}: {e}")
+
+    thread = threading.Thread(target=_grant, daemon=True)
+    thread.start()
+
+def _build_media(file_bytes: bytes, mimetype: str):
+    """Picks the cheapest upload strategy for the payload size."""
+    if len(file_bytes) < _RESUMABLE_THRESHOLD_BYTES:
+        return MediaInMemoryUpload(file_bytes, mimetype=mimetype, resumable=False)
+    return MediaIoBaseUpload(
+        io.BytesIO(file_bytes),
+        mimetype=mimetype,
+        chunksize=_RESUMABLE_CHUNK_SIZE,
+        resumable=True,
+    )
+
 def save_file(file_bytes: bytes, date: str, file_name: str, mimetype: str):
     """Saves image bytes to a specified local folder."""
     try:
@@ -89,26 +252,39 @@ def get_folder_id_by_date(root_id, full_date):
     Obtiene la ruta Año/Mes (ej: 2025/01).
     Retorna el ID de la carpeta del mes final.
     """
-    date = datetime.strptime(full_date, "%Y-%m-%d %H:%M:%S")
+    date = datetime.datetime.strptime(full_date, "%Y-%m-%d %H:%M:%S")
     year = date.strftime("%Y")  # "2025"
-    month = dare.strftime("%m")   # "01"
+    month = date.strftime("%m")   # "01"
 
     # 1. Buscar/Crear carpeta del Año
     year_id = get_or_create_subfolder(year, root_id)
-    
+
     # 2. Buscar/Crear carpeta del Mes dentro del Año
-    month_id = get_or_create_subfolder(month, year_id_id)
-    
+    month_id = get_or_create_subfolder(month, year_id)
+
     return month_id
 
+# Year/month folders never move once resolved, so (name, parent) -> id is
+# cached in-process with a TTL instead of paying two files().list round
+# trips on every upload. Same shape as the allow-list cache in app_service.
+_folder_cache: dict = {}
+_folder_cache_lock = threading.Lock()
+_FOLDER_CACHE_TTL_SECONDS = 3600.0
+_FOLDER_CACHE_MAX = 512
+
 def get_or_create_subfolder(folder_name: str, parent_id: str):
     """Busca una subcarpeta por nombre dentro de una carpeta padre. Si no existe, la crea."""
-    
-    try:
-        scopes = ["https://www.googleapis.com/auth/drive"]
-        creds, project_id = default(scopes=scopes)
 
-        service = build('drive', 'v3', credentials=creds)
+    cache_key = (folder_name, parent_id)
+    with _folder_cache_lock:
+        cached = _folder_cache.get(cache_key)
+        if cached is not None and time.monotonic() - cached[1] < _FOLDER_CACHE_TTL_SECONDS:
+            return cached[0]
+
+    try:
+        service = _get_drive_service()
+        if not service:
+            return parent_id
 
         query = (f"name = '{folder_name}' and "
                  f"'{parent_id}' in parents and "
@@ -126,10 +302,17 @@ def get_or_create_subfolder(folder_name: str, parent_id: str):
     
 
         if items:
-            logging.info(f"Subcarpeta encontrada: {folder_name} (ID: {items[0]['id']})")
-            return items[0]['id']
-       
-        logging.info(f"Subcarpeta no encontrada: {folder_name}, usando padre (ID: {parent_id})")
+            folder_id = items[0]['id']
+            logging.info("Subcarpeta encontrada: %s (ID: %s)", folder_name, folder_id)
+            # Only real resolutions are cached; the parent-id fallback below
+            # is a degraded answer that should be retried next time.
+            with _folder_cache_lock:
+                if len(_folder_cache) >= _FOLDER_CACHE_MAX:
+                    _folder_cache.clear()
+                _folder_cache[cache_key] = (folder_id, time.monotonic())
+            return folder_id
+
+        logging.info("Subcarpeta no encontrada: %s, usando padre (ID: %s)", folder_name, parent_id)
         return parent_id
 
     except Exception as e:
@@ -139,36 +322,29 @@ def get_or_create_subfolder(folder_name: str, parent_id: str):
 def upload_image_to_drive(image_bytes: bytes, filename: str, folder_id: str):
     
     try:
-        scopes = ["https://www.googleapis.com/auth/drive"]
-        creds, project_id = default(scopes=scopes)
-        service = build('drive', 'v3', credentials=creds)
+        service = _get_drive_service()
+        if not service:
+            return None
 
         file_metadata = {
             'name': filename,
             'parents': [folder_id]
         }
         
-        media = MediaIoBaseUpload(
-            io.BytesIO(image_bytes), 
-            mimetype='image/jpeg', 
-            resumable=False
-        )
+        media = _build_media(image_bytes, 'image/jpeg')
 
-        file = service.files().create(
+        file = _execute_with_backoff(service.files().create(
             body=file_metadata,
             media_body=media,
-            fields='id, webViewLink',
+            fields='id',
             # Esto ayuda a que Google entienda que se sube a un recurso compartido
-            supportsAllDrives=True 
-        ).execute()
+            supportsAllDrives=True
+        ))
 
         # Si quieres que Leo pueda leerlo luego, esto está bien
-        service.permissions().create(
-            fileId=file.get('id'),
-            body={'type': 'anyone', 'role': 'viewer'}
-        ).execute()
+        _grant_public_read_async(file.get('id'))
 
-        return file.get('webViewLink')
+        return _drive_view_link(file.get('id'))
 
     except Exception as e:
         logging.error(f"Error subiendo a Google Drive: {e}")
@@ -180,9 +356,9 @@ def upload_file_to_drive(file_bytes: bytes, filename: str, folder_id: str, mimet
     """
 
     try:
-        scopes = ["https://www.googleapis.com/auth/drive"]
-        creds, project_id = default(scopes=scopes)
-        service = build('drive', 'v3', credentials=creds)
+        service = _get_drive_service()
+        if not service:
+            return None
 
         file_metadata = {
             'name': filename,
@@ -190,27 +366,20 @@ def upload_file_to_drive(file_bytes: bytes, filename: str, folder_id: str, mimet
         }
         
         # Usamos el mimetype que viene de WhatsApp (ej: 'application/pdf' o 'image/png')
-        media = MediaIoBaseUpload(
-            io.BytesIO(file_bytes), 
-            mimetype=mimetype, 
-            resumable=False
-        )
+        media = _build_media(file_bytes, mimetype)
 
-        file = service.files().create(
+        file = _execute_with_backoff(service.files().create(
             body=file_metadata,
             media_body=media,
-            fields='id, webViewLink',
-            supportsAllDrives=True 
-        ).execute()
+            fields='id',
+            supportsAllDrives=True
+        ))
 
         # Permisos para que sea consultable
-        service.permissions().create(
-            fileId=file.get('id'),
-            body={'type': 'anyone', 'role': 'viewer'}
-        ).execute()
+        _grant_public_read_async(file.get('id'))
 
-        logging.info(f"Archivo subido correctamente: {filename} ({mimetype})")
-        return file.get('webViewLink')
+        logging.info("Archivo subido correctamente: %s (%s)", filename, mimetype)
+        return _drive_view_link(file.get('id'))
 
     except Exception as e:
         logging.error(f"Error subiendo a Google Drive: {e}")
@@ -220,24 +389,17 @@ def upload_file_to_drive(file_bytes: bytes, filename: str, folder_id: str, mimet
 def get_authorized_users():
     """Lee los números permitidos de la pestaña 'Usuarios'."""
     try:
-        creds, sheet_id, _ = _get_google_creds()
-        if not creds:
-            logging.error("Google Sheet ID or Credentials Path not found in environment variables.")
-            return
-        
-        logging.info("gspread.authorize")
-        gs_client = gspread.authorize(creds)
-
-        logging.info("open_by_key")
-        spreadsheet = gs_client.open_by_key(sheet_id)
-        
-        logging.info(f"Intentando leer hoja: {sheet_id} en el rango 'Usuarios!A2:A'")
-
-        logging.info("worksheet Usuarios")
-        sheet = spreadsheet.worksheet("Usuarios")
+        service = _get_sheets_service()
+        sheet_id = get_secret("GOOGLE_SHEET_ID")
+        if not service or not sheet_id:
+            return []
 
-        logging.info("get range A2:A")
-        values = sheet.get("A2:A")
+        logging.info("Intentando leer el rango 'Usuarios!A2:A'")
+        result = service.spreadsheets().values().get(
+            spreadsheetId=sheet_id,
+            range="Usuarios!A2:A",
+        ).execute()
+        values = result.get('values', [])
 
         # Flatten lista de listas
         authorized_numbers = [row[0] for row in values if row]
@@ -249,9 +411,6 @@ def get_authorized_users():
         logging.info(f"Successfully read {len(authorized_numbers)} users from column A")
         return authorized_numbers
         
-    except NameError as ne:
-        logging.error(f"Error de variable no definida: {ne}")
-        return []
     except Exception as e:
         # El log detallado nos dirá si es un error de permisos, de red o de ID
         logging.error(f"Error crítico leyendo usuarios: {e}", exc_info=True)
@@ -9,6 +9,10 @@ from google.cloud import secretmanager
 # Simple in-memory cache to store secrets during the application's lifecycle
 _cache: Dict[str, str] = {}
 
+# Resolved once at import time; every get_secret call was re-reading the
+# environment for the same value.
+PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT")
+
 # Initialize the client outside of the function to reuse it
 try:
     client = secretmanager.SecretManagerServiceClient()
@@ -42,7 +46,7 @@ def get_secret(secret_id: str, project_id: Optional[str] = None) -> Optional[str
         return _cache[secret_id]
 
     if not project_id:
-        project_id = os.getenv("GOOGLE_CLOUD_PROJECT")
+        project_id = PROJECT_ID
 
     if not project_id:
         logging.error("GOOGLE_CLOUD_PROJECT environment variable not set. Cannot fetch secret.")
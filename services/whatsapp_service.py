@@ -1,73 +1,310 @@
 """Handles all interactions with the WhatsApp Business API."""
 
+import asyncio
+import io
+import json
 import logging
+import time
 import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
+from urllib.parse import urlencode
 
 from .secrets import get_secret
 
+# Module logger resolved once; lazy %-formatting skips the argument work
+# when the level is filtered out.
+logger = logging.getLogger(__name__)
+
+# orjson emits bytes directly and serializes the small send payload several
+# times faster than the stdlib; same fallback pattern as routes.py.
+try:
+    import orjson
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+    _json_loads = json.loads
+
+# One pooled session for every Graph API call, so the TCP+TLS handshake to
+# graph.facebook.com is paid once per connection instead of once per request.
+# Transient Graph API failures are retried at the adapter level with backoff.
+_session = requests.Session()
+_session.mount(
+    "https://",
+    requests.adapters.HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=50,
+        max_retries=requests.adapters.Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 502, 503, 504],
+            allowed_methods=["GET", "POST"],
+        ),
+    ),
+)
+
+# HTTP/2 client for the media path: the URL lookup and the binary download
+# hit the same origin back to back, so multiplexing them over one TLS
+# connection avoids a second handshake. Falls back to the pooled session.
+try:
+    import httpx
+    _http2_client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=40, max_keepalive_connections=20),
+        timeout=httpx.Timeout(10.0, connect=3.0),
+    )
+except ImportError:
+    _http2_client = None
+
+_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# (connect, read) timeout for every requests call: a hung Meta endpoint
+# releases its pool slot after seconds instead of pinning a worker forever.
+_TIMEOUT = (3.05, 10)
+
+def _media_get(url: str, headers: dict):
+    """GETs a media endpoint over HTTP/2 when available."""
+    if _http2_client is not None:
+        return _http2_client.get(url, headers=headers)
+    return _session.get(url, headers=headers, timeout=_TIMEOUT)
+
+# The token and phone number ID are static for the process lifetime, so
+# they are resolved once and the auth headers are prebuilt instead of
+# re-fetching the secrets and rebuilding the dicts on every message.
+_wa_creds = None
+
+def _get_wa_credentials():
+    """Returns cached (access_token, phone_number_id, json_headers, auth_headers, send_url)."""
+    global _wa_creds
+    if _wa_creds is None:
+        access_token = get_secret("WHATSAPP_ACCESS_TOKEN")
+        phone_number_id = get_secret("WHATSAPP_PHONE_NUMBER_ID")
+        if not access_token or not phone_number_id:
+            logger.error("WhatsApp API credentials could not be retrieved from Secret Manager.")
+            return None, None, None, None, None
+        _wa_creds = (
+            access_token,
+            phone_number_id,
+            {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
+            {"Authorization": f"Bearer {access_token}"},
+            f"https://graph.facebook.com/v19.0/{phone_number_id}/messages",
+        )
+    return _wa_creds
+
 # --- WhatsApp Business API Functions ---
 
+# URL parsing, cookie merging and header normalization run once on this
+# template; each send copies it and swaps in the recipient-specific body.
+_prepared_template = None
+
+def _get_prepared_template():
+    global _prepared_template
+    if _prepared_template is None:
+        _, _, headers, _, url = _get_wa_credentials()
+        if not url:
+            return None
+        _prepared_template = _session.prepare_request(
+            requests.Request("POST", url, headers=headers)
+        )
+    return _prepared_template
+
 def send_whatsapp_message(to: str, message: str):
     """Sends a WhatsApp message using the Meta Graph API."""
-    access_token = get_secret("WHATSAPP_ACCESS_TOKEN")
-    phone_number_id = get_secret("WHATSAPP_PHONE_NUMBER_ID")
-    
-    if not all([access_token, phone_number_id]):
-        logging.error("WhatsApp API credentials could not be retrieved from Secret Manager.")
+    template = _get_prepared_template()
+    if template is None:
+        return
+
+    body = _json_dumps({
+        "messaging_product": "whatsapp",
+        "to": to,
+        "text": {"body": message}
+    })
+
+    prepared = template.copy()
+    prepared.body = body
+    prepared.headers["Content-Length"] = str(len(body))
+
+    try:
+        response = _session.send(prepared, timeout=_TIMEOUT)
+        response.raise_for_status() # Raises an HTTPError for bad responses (4xx or 5xx)
+        logger.info("WhatsApp message sent to %s. Status: %s", to, response.status_code)
+    except requests.exceptions.RequestException as e:
+        logger.error("Error sending WhatsApp message: %s", e)
+
+# Async sends for broadcast scenarios: N messages ride concurrently on the
+# multiplexed HTTP/2 connection instead of paying N serial round trips.
+# Created lazily so importing this module never requires httpx.
+_async_client = None
+
+# Caps concurrent sends below the Meta messages-per-second quota.
+_BROADCAST_MAX_IN_FLIGHT = 20
+_broadcast_semaphore = asyncio.Semaphore(_BROADCAST_MAX_IN_FLIGHT)
+
+def _get_async_client():
+    global _async_client
+    if _async_client is None and _http2_client is not None:
+        _async_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            timeout=30,
+        )
+    return _async_client
+
+async def send_whatsapp_message_async(to: str, message: str):
+    """Async variant of send_whatsapp_message for concurrent sends."""
+    _, _, headers, _, url = _get_wa_credentials()
+    if not url:
+        return
+
+    client = _get_async_client()
+    if client is None:
+        # httpx is not installed: run the sync path without blocking the loop.
+        await asyncio.to_thread(send_whatsapp_message, to, message)
         return
 
-    url = f"https://graph.facebook.com/v19.0/{phone_number_id}/messages"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-    }
     data = {
         "messaging_product": "whatsapp",
         "to": to,
         "text": {"body": message}
     }
-    
+
     try:
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status() # Raises an HTTPError for bad responses (4xx or 5xx)
-        logging.info(f"WhatsApp message sent to {to}. Status: {response.status_code}")
+        async with _broadcast_semaphore:
+            response = await client.post(url, headers=headers, content=_json_dumps(data))
+        response.raise_for_status()
+        logger.info("WhatsApp message sent to %s. Status: %s", to, response.status_code)
+    except Exception as e:
+        logger.error("Error sending WhatsApp message: %s", e)
+
+async def broadcast(tos: list, message: str):
+    """Sends one message to many recipients concurrently."""
+    await asyncio.gather(*(send_whatsapp_message_async(to, message) for to in tos))
+
+# Thread-pooled fan-out for synchronous callers without an event loop. The
+# GIL is released during socket I/O, so sends overlap up to the pool size;
+# the session's pool_maxsize comfortably covers the worker count.
+_send_executor = ThreadPoolExecutor(max_workers=16)
+
+def send_many(tos: list, message: str):
+    """Sends the same message to many recipients in parallel threads."""
+    if not tos:
+        return
+    list(_send_executor.map(lambda to: send_whatsapp_message(to, message), tos))
+
+def send_whatsapp_messages(messages: list):
+    """Envía varios mensajes (to, body) en una sola petición batch de Graph.
+
+    Collapses N message POSTs into one HTTP round-trip; Meta executes the
+    batched operations server-side.
+    """
+    if not messages:
+        return
+    if len(messages) == 1:
+        to, body = messages[0]
+        send_whatsapp_message(to, body)
+        return
+
+    access_token, phone_number_id, _, _, _ = _get_wa_credentials()
+    if not access_token:
+        return
+
+    batch = [
+        {
+            "method": "POST",
+            "relative_url": f"v19.0/{phone_number_id}/messages",
+            "body": urlencode({
+                "messaging_product": "whatsapp",
+                "to": to,
+                "text": json.dumps({"body": body}),
+            }),
+        }
+        for to, body in messages
+    ]
+
+    try:
+        response = _session.post(
+            "https://graph.facebook.com/",
+            data={"access_token": access_token, "batch": json.dumps(batch)},
+            timeout=_TIMEOUT,
+        )
+        response.raise_for_status()
+        logger.info("Sent %d WhatsApp messages in one batch request.", len(messages))
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error sending WhatsApp message: {e}")
+        logger.error("Error sending batched WhatsApp messages, falling back to singles: %s", e)
+        for to, body in messages:
+            send_whatsapp_message(to, body)
+
+# Duplicate webhook deliveries resolve the same media_id; a small LRU skips
+# the lookup round trip. Meta signs these URLs with a ~5 minute expiry, so
+# entries die well before the signature does.
+_media_url_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_MEDIA_URL_CACHE_MAX = 1024
+_MEDIA_URL_TTL_SECONDS = 240.0
 
 def get_media_url(media_id: str) -> Optional[str]:
     """Sirve para cualquier archivo: imagen, PDF, video, etc."""
-    access_token = get_secret("WHATSAPP_ACCESS_TOKEN")
-    if not access_token:
-        logging.error("WHATSAPP_ACCESS_TOKEN could not be retrieved from Secret Manager.")
+    cached = _media_url_cache.get(media_id)
+    if cached is not None and time.monotonic() - cached[1] < _MEDIA_URL_TTL_SECONDS:
+        _media_url_cache.move_to_end(media_id)
+        return cached[0]
+
+    _, _, _, headers, _ = _get_wa_credentials()
+    if not headers:
         return None
-    
+
     # El endpoint es el mismo para todos los tipos de media
     url = f"https://graph.facebook.com/v20.0/{media_id}"
-    headers = {"Authorization": f"Bearer {access_token}"}
-    
+
     try:
-        response = requests.get(url, headers=headers)
+        response = _media_get(url, headers)
         response.raise_for_status()
-        return response.json().get("url")
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error getting media URL ({media_id}): {e}")
+        # Parse the small response with orjson instead of the client's
+        # stdlib-backed .json() helper.
+        media_url = _json_loads(response.content).get("url")
+        if media_url:
+            _media_url_cache[media_id] = (media_url, time.monotonic())
+            _media_url_cache.move_to_end(media_id)
+            while len(_media_url_cache) > _MEDIA_URL_CACHE_MAX:
+                _media_url_cache.popitem(last=False)
+        return media_url
+    except Exception as e:
+        logger.error("Error getting media URL (%s): %s", media_id, e)
         return None
 
-def download_media_content(media_url: str) -> Optional[bytes]:
-    """Downloads the raw bytes of a media file from the given URL."""
-    access_token = get_secret("WHATSAPP_ACCESS_TOKEN")
-    if not access_token:
-        logging.error("WHATSAPP_ACCESS_TOKEN could not be retrieved for media download.")
-        return None
-        
-    headers = {"Authorization": f"Bearer {access_token}"}
-    
+def download_media_to(media_url: str, sink) -> bool:
+    """Streams a media body into a caller-provided writable sink.
+
+    Writing chunks straight into the sink keeps only one chunk in flight,
+    so callers can hand in a file or pipe and never hold the full payload
+    in RAM. Returns True on success.
+    """
+    _, _, _, headers, _ = _get_wa_credentials()
+    if not headers:
+        return False
+
     try:
         # Importante: WhatsApp requiere el token incluso para la descarga del binario
-        response = requests.get(media_url, headers=headers)
-        response.raise_for_status()
-        return response.content
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error downloading media content: {e}")
+        if _http2_client is not None:
+            with _http2_client.stream("GET", media_url, headers=headers) as response:
+                response.raise_for_status()
+                for chunk in response.iter_bytes(_DOWNLOAD_CHUNK_SIZE):
+                    sink.write(chunk)
+        else:
+            with _session.get(media_url, headers=headers, stream=True, timeout=_TIMEOUT) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(_DOWNLOAD_CHUNK_SIZE):
+                    sink.write(chunk)
+        return True
+    except Exception as e:
+        logger.error("Error downloading media content: %s", e)
+        return False
+
+def download_media_content(media_url: str) -> Optional[bytes]:
+    """Downloads the raw bytes of a media file from the given URL."""
+    buffer = io.BytesIO()
+    if not download_media_to(media_url, buffer):
         return None
+    return buffer.getvalue()
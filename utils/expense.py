@@ -0,0 +1,36 @@
+"""Typed view over the expense JSON returned by the AI service."""
+
+from dataclasses import dataclass
+from typing import Optional
+
+@dataclass(frozen=True)
+class ExpenseData:
+    """One parsed Gemini extraction.
+
+    Normalizes the shape in a single place instead of scattering dict.get
+    calls with ad-hoc defaults through the handler.
+    """
+    valid_expense: bool = False
+    message: str = ""
+    concept: str = ""
+    amount: Optional[float] = None
+    category: str = ""
+    subcategory: str = ""
+    currency: str = ""
+    date: Optional[str] = None
+    folder: str = "Unknown"
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ExpenseData":
+        """Builds an ExpenseData from the raw JSON dict, tolerating nulls."""
+        return cls(
+            valid_expense=bool(data.get('valid_expense') or False),
+            message=data.get('message') or "",
+            concept=data.get('concept') or "",
+            amount=data.get('amount'),
+            category=data.get('category') or "",
+            subcategory=data.get('subcategory') or "",
+            currency=data.get('currency') or "",
+            date=data.get('date'),
+            folder=data.get('folder') or "Unknown",
+        )
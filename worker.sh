@@ -0,0 +1,6 @@
+#!/bin/sh
+source .venv/bin/activate
+
+# Green threads multiplex the Gemini/Sheets/WhatsApp socket waits, so one
+# host keeps hundreds of requests in flight instead of one per core.
+celery -A celery_app worker -P gevent -c ${CELERY_WORKER_CONCURRENCY:-300}